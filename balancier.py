@@ -1,101 +1,136 @@
 #!/usr/bin/env python
 
+import csv
 import logging
-
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-
-
-class KwargInitMixin(object):
-    def __init__(self, *args, **kwargs):
-        '''
-        Initialize an object setting all properties from kwargs, useful for
-        consuming CSVs
-        '''
-        for key, val in kwargs.items():
-            setattr(self, key, val)
-
-
-class Facility(KwargInitMixin):
-    def __init__(self, *args, **kwargs):
-        super(Facility, self).__init__(*args, **kwargs)
-        self.bank = None
-        self.banned_states = []
-        self.max_default_likelihood = None
-        self.interest_rate = float(self.interest_rate)
-        self.assigned_loans = []
-        self.amount = float(self.amount)
+import math
+import operator
+import os
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from balancier_kernels import assign_loans, get_num_threads, resolve_assignments, score_loans
+
+log = logging.getLogger(__name__)
+
+# cache line size, so kernel loads over the facility and loan arrays start on a boundary
+ARRAY_ALIGNMENT = 64
+# loans scored ahead in parallel by make_assignments before their picks are resolved
+SPECULATE_BLOCK = 16384
+# share of a block's picks that may go stale before make_assignments goes serial
+MAX_RESCORE_RATE = 0.25
+
+
+def aligned_array(values: Iterable, dtype: type, count: int = -1,
+                  alignment: int = ARRAY_ALIGNMENT) -> np.ndarray:
+    '''
+    Builds a C-contiguous array from an iterable, with its data starting on an
+    alignment-byte boundary.
+    '''
+    array: np.ndarray = np.fromiter(values, dtype, count)
+    buf = np.empty(array.nbytes + alignment, dtype=np.uint8)
+    offset = -buf.ctypes.data % alignment
+    result = buf[offset:offset + array.nbytes].view(array.dtype)
+    result[...] = array
+    return result
+
+
+def read_rows(directory: str, filename: str, fields: Sequence[str]) -> Iterator[Tuple[str, ...]]:
+    '''
+    Yields the named fields of each row of a CSV file, in the order given. Columns are looked
+    up in the header once, so rows are never turned into dicts. fields must name at least two
+    columns, since itemgetter returns a bare value rather than a tuple for one.
+    '''
+    with open(os.path.join(directory, filename), newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        pick = operator.itemgetter(*[header.index(name) for name in fields])
+        for row in reader:
+            # csv.reader gives blank lines back as empty rows
+            if not row:
+                continue
+            yield pick(row)
+
+
+# columns read by Facility.from_row, in order
+FACILITY_FIELDS = ('id', 'bank_id', 'amount', 'interest_rate')
+
+
+@dataclass(slots=True, eq=False)
+class Facility:
+    id: int
+    bank_id: int
+    amount: float
+    interest_rate: float
+    bank: Optional['Bank'] = field(default=None, repr=False)
+    banned_states: List[str] = field(default_factory=list)
+    max_default_likelihood: Optional[float] = None
+    assigned_loans: List['Loan'] = field(default_factory=list, repr=False)
+    # bank and facility covenants combined, filled in by Balancier.normalize_data
+    _eff_banned: FrozenSet[str] = field(default=frozenset(), init=False, repr=False)
+    _eff_max_dl: Optional[float] = field(default=None, init=False, repr=False)
+    _banned_mask: int = field(default=0, init=False, repr=False)
+    # running total of expected yield over assigned_loans
+    _yield_accum: float = field(default=0.0, init=False, repr=False)
+
+    @classmethod
+    def from_row(cls, row: Sequence[str]) -> 'Facility':
+        id, bank_id, amount, interest_rate = row
+        return cls(int(id), int(bank_id), float(amount), float(interest_rate))
 
     @property
-    def effective_banned_states(self):
+    def effective_banned_states(self) -> FrozenSet[str]:
         '''
         Gets all effective banned states from parent bank as well as facility
         '''
-        return self.banned_states + self.bank.banned_states
+        return self._eff_banned
 
     @property
-    def effective_max_default_likelihood(self):
+    def effective_max_default_likelihood(self) -> Optional[float]:
         '''
         Gets the smallest maximum default likelihood from parent bank as well as facility
         '''
-        if self.bank.max_default_likelihood and self.max_default_likelihood:
-            return min(self.max_default_likelihood, self.bank.max_default_likelihood)
-        return self.bank.max_default_likelihood or self.max_default_likelihood
+        return self._eff_max_dl
 
-    def validate_loan(self, loan):
+    def validate_loan(self, loan: 'Loan') -> bool:
         '''
         Validates that there are no covenants in place which would restrict this loan
         from originating.
         '''
-        if loan.state in self.effective_banned_states:
-            logging.debug('Invalid due to originating state: {}, Banned States: {}'.format(
-                loan.state,
-                self.effective_banned_states,
-            ))
+        if loan._state_bit & self._banned_mask:
             return False
-        if loan.default_likelihood > self.effective_max_default_likelihood:
-            logging.debug('Invalid due to default likelihood: {}, Max likelihood: {}'.format(
-                loan.default_likelihood,
-                self.effective_max_default_likelihood,
-            ))
+        # no max default likelihood covenant means any loan is acceptable
+        if self._eff_max_dl is not None and loan.default_likelihood > self._eff_max_dl:
             return False
         if loan.amount > self.amount:
-            logging.debug('Invalid due insufficient facility funds: {}, Loan amount: {}'.format(
-                self.amount,
-                loan.amount,
-            ))
             return False
-        logging.debug('Facility is valid.')
         return True
 
-    def calculate_yield_for_loan(self, loan):
+    def calculate_yield_for_loan(self, loan: 'Loan') -> float:
         '''
         Calculates expected yield if the loan were assigned to this facility
         '''
-        expected_yield = ((1. - loan.default_likelihood) * loan.interest_rate * loan.amount
-                          - loan.default_likelihood * loan.amount
-                          - self.interest_rate * loan.amount)
-        return expected_yield
+        return loan.amount * (loan._yield_coeff - self.interest_rate)
 
-    def calculate_total_yield(self):
+    def calculate_total_yield(self) -> int:
         '''
         Returns projected yield for all loans assigned to the facility, rounded to the nearest
         penny.
         '''
-        total = 0
-        for loan in self.assigned_loans:
-            total += loan.expected_yield
-        return int(round(total))
+        return int(round(self._yield_accum))
 
-    def assign_loan(self, loan, expected_yield):
+    def assign_loan(self, loan: 'Loan', expected_yield: float) -> None:
         '''
         Assigns the specified loan to this facility
         '''
         self.assigned_loans.append(loan)
         loan.assigned_facility = self
         loan.expected_yield = expected_yield
+        self._yield_accum += expected_yield
         self.amount -= loan.amount
 
-    def __str__(self):
+    def __str__(self) -> str:
         return 'Facility: {}, Amount: {}, Loans: {}, Total Yield: {}'.format(
             self.id,
             self.amount,
@@ -104,60 +139,97 @@ class Facility(KwargInitMixin):
         )
 
 
-class Bank(KwargInitMixin):
-    def __init__(self, *args, **kwargs):
-        super(Bank, self).__init__(*args, **kwargs)
-        self.facilities = []
-        self.banned_states = []
-        self.max_default_likelihood = None
+# columns read by Bank.from_row, in order
+BANK_FIELDS = ('id', 'name')
+
+
+@dataclass(slots=True, eq=False)
+class Bank:
+    id: int
+    name: str = ''
+    facilities: List[Facility] = field(default_factory=list, repr=False)
+    banned_states: List[str] = field(default_factory=list)
+    max_default_likelihood: Optional[float] = None
+
+    @classmethod
+    def from_row(cls, row: Sequence[str]) -> 'Bank':
+        id, name = row
+        return cls(int(id), name)
+
+
+# columns read by Covenant.from_row, in order
+COVENANT_FIELDS = (
+    'bank_id', 'facility_id', 'max_default_likelihood', 'banned_state',
+)
+
+
+@dataclass(slots=True, eq=False)
+class Covenant:
+    bank_id: int
+    facility_id: Optional[int] = None
+    max_default_likelihood: Optional[float] = None
+    banned_state: Optional[str] = None
+    bank: Optional[Bank] = field(default=None, init=False, repr=False)
+    facility: Optional[Facility] = field(default=None, init=False, repr=False)
+
+    @classmethod
+    def from_row(cls, row: Sequence[str]) -> 'Covenant':
+        bank_id, facility_id, max_default_likelihood, banned_state = row
+        return cls(
+            int(bank_id),
+            int(facility_id) if facility_id else None,
+            float(max_default_likelihood) if max_default_likelihood else None,
+            banned_state or None,
+        )
+
+
+# columns read by Loan.from_row, in order
+LOAN_FIELDS = ('id', 'amount', 'interest_rate', 'default_likelihood', 'state')
 
 
-class Covenant(KwargInitMixin):
-    def __init__(self, *args, **kwargs):
-        super(Covenant, self).__init__(*args, **kwargs)
-        self.bank = None
-        self.facility = None
+@dataclass(slots=True, eq=False)
+class Loan:
+    id: int
+    amount: float
+    interest_rate: float
+    default_likelihood: float
+    state: str
+    assigned_facility: Optional[Facility] = field(default=None, repr=False)
+    expected_yield: Optional[float] = None
+    # bit for this loan's state, see Balancier.state_bits
+    _state_bit: int = field(default=0, init=False, repr=False)
+    # expected yield per dollar before the facility's interest rate is taken out
+    _yield_coeff: float = field(default=0.0, init=False, repr=False)
 
+    def __post_init__(self) -> None:
+        self._yield_coeff = (1. - self.default_likelihood) * self.interest_rate - self.default_likelihood
 
-class Loan(KwargInitMixin):
-    def __init__(self, *args, **kwargs):
-        super(Loan, self).__init__(*args, **kwargs)
-        self.assigned_facility = None
-        self.expected_yield = None
-        self.amount = float(self.amount)
-        self.default_likelihood = float(self.default_likelihood)
-        self.interest_rate = float(self.interest_rate)
+    @classmethod
+    def from_row(cls, row: Sequence[str]) -> 'Loan':
+        id, amount, interest_rate, default_likelihood, state = row
+        return cls(int(id), float(amount), float(interest_rate), float(default_likelihood), state)
 
-    def assign(self, facilities):
+    def assign(self, facilities: Iterable[Facility]) -> Optional[Facility]:
         '''
         Searches through all provided facilities finding the best one to assign the loan to.
         '''
-        max_yield = None
+        max_yield = -math.inf
         selected_facility = None
         for facility in facilities:
-            logging.debug('Validating facility: {}'.format(facility.id))
-            if not facility.validate_loan(self):
-                logging.debug(' - Facility is invalid')
-            else:
+            if facility.validate_loan(self):
                 expected_yield = facility.calculate_yield_for_loan(self)
-                logging.debug(' - Expected yield: {}'.format(expected_yield))
-                if not expected_yield or expected_yield > max_yield:
+                if expected_yield > max_yield:
                     max_yield = expected_yield
                     selected_facility = facility
-                    logging.debug(' - Best facility so far: {}, amount: {}, expected yield: {}'.format(
-                        selected_facility.id,
-                        self.amount,
-                        self.expected_yield
-                    ))
-                else:
-                    logging.debug(' - Not optimal')
         if not selected_facility:
-            logging.warning('Unable to assign loan: {}, Amount: {}'.format(self.id, self.amount))
-            return
+            log.warning('Unable to assign loan: %s, Amount: %s', self.id, self.amount)
+            return None
+        log.debug('Loan: %s, assigned to facility: %s, expected yield: %s',
+                  self.id, selected_facility.id, max_yield)
         selected_facility.assign_loan(self, max_yield)
-        return facility
+        return selected_facility
 
-    def __str__(self):
+    def __str__(self) -> str:
         return 'Loan {}, Assigned: {}, Amount: {}'.format(
             self.id,
             self.assigned_facility.id if self.assigned_facility else 'X',
@@ -166,89 +238,187 @@ class Loan(KwargInitMixin):
 
 
 class Balancier(object):
-    def __init__(self):
-        self.covenants, self.banks, self.loans, self.facilities = [], [], [], []
+    def __init__(self) -> None:
+        self.covenants: List[Covenant] = []
+        self.banks: List[Bank] = []
+        self.loans: List[Loan] = []
+        self.facilities: List[Facility] = []
         # for quick lookups
-        self.bank_table, self.facility_table = {}, {}
-
-    def read_data(self, directory):
-        files = [
-                    (Bank, 'banks.csv', self.banks),
-                    (Covenant, 'covenants.csv', self.covenants),
-                    (Facility, 'facilities.csv', self.facilities),
-                    (Loan, 'loans.csv', self.loans),
-                ]
-        for (klass, filename, collection) in files:
-            lines = open('./{}/{}'.format(directory, filename)).readlines()
-            fields = lines.pop(0).strip().split(',')
-            for line in lines:
-                kwargs = dict(zip(fields, line.strip().split(',')))
-                collection.append(klass(**kwargs))
-
-    def normalize_data(self):
+        self.bank_table: Dict[int, Bank] = {}
+        self.facility_table: Dict[int, Facility] = {}
+        self.state_bits: Dict[str, int] = {}
+
+    def read_data(self, directory: str) -> None:
+        self.banks.extend(map(Bank.from_row, read_rows(directory, 'banks.csv', BANK_FIELDS)))
+        self.covenants.extend(map(Covenant.from_row,
+                                  read_rows(directory, 'covenants.csv', COVENANT_FIELDS)))
+        self.facilities.extend(map(Facility.from_row,
+                                   read_rows(directory, 'facilities.csv', FACILITY_FIELDS)))
+        self.loans.extend(map(Loan.from_row, read_rows(directory, 'loans.csv', LOAN_FIELDS)))
+
+        # give every state that can show up its own bit, so banned states become a bitmask
+        states = {loan.state for loan in self.loans}
+        states.update(covenant.banned_state for covenant in self.covenants if covenant.banned_state)
+        if len(states) > 64:
+            raise ValueError('Too many states to encode as a bitmask: {}'.format(len(states)))
+        self.state_bits = {state: 1 << i for i, state in enumerate(sorted(states))}
+
+    def normalize_data(self) -> None:
         for bank in self.banks:
             self.bank_table[bank.id] = bank
-
         for facility in self.facilities:
             self.facility_table[facility.id] = facility
-            facility.bank = self.bank_table[facility.bank_id]
-            facility.bank.facilities.append(facility)
+
+        for facility in self.facilities:
+            parent = self.bank_table.get(facility.bank_id)
+            if parent is None:
+                raise KeyError('Facility {} has unknown bank: {}'.format(facility.id, facility.bank_id))
+            facility.bank = parent
+            parent.facilities.append(facility)
 
         for covenant in self.covenants:
-            covenant.bank = self.bank_table[covenant.bank_id]
-            if covenant.facility_id:
-                covenant.facility = self.facility_table[covenant.facility_id]
+            covenant.bank = self.bank_table.get(covenant.bank_id)
+            if covenant.bank is None:
+                raise KeyError('Covenant has unknown bank: {}'.format(covenant.bank_id))
+            if covenant.facility_id is not None:
+                covenant.facility = self.facility_table.get(covenant.facility_id)
+                if covenant.facility is None:
+                    raise KeyError('Covenant has unknown facility: {}'.format(covenant.facility_id))
 
             # assign this covenant to its facility or bank
             entity = covenant.facility or covenant.bank
             if covenant.banned_state:
                 entity.banned_states.append(covenant.banned_state)
-            if covenant.max_default_likelihood:
+            if covenant.max_default_likelihood is not None:
                 # take the smallest max_default_likelihood from all covenants
                 if (entity.max_default_likelihood is None or
-                        entity.max_default_likelihood < covenant.max_default_likelihood):
+                        entity.max_default_likelihood > covenant.max_default_likelihood):
                     entity.max_default_likelihood = covenant.max_default_likelihood
 
-    def make_assignments(self):
+        # covenants are static from here on, combine bank and facility restrictions once
+        for facility in self.facilities:
+            parent = facility.bank
+            assert parent is not None
+            facility._eff_banned = frozenset(facility.banned_states) | frozenset(parent.banned_states)
+            max_dls = [dl for dl in (facility.max_default_likelihood, parent.max_default_likelihood)
+                       if dl is not None]
+            facility._eff_max_dl = min(max_dls) if max_dls else None
+            for state in facility._eff_banned:
+                facility._banned_mask |= self.state_bits[state]
+
         for loan in self.loans:
-            logging.debug('Assigning loan: {}'.format(loan.id))
-            loan.assign(self.facilities)
+            loan._state_bit = self.state_bits[loan.state]
+
+        self.build_facility_arrays()
+        self.build_loan_arrays()
 
-    def write_assignments(self):
-        f = open('assignment_ben.csv', 'w')
-        f.write('loan_id,facility_id\n')
+    def build_facility_arrays(self) -> None:
+        '''
+        Lays out facility state as parallel arrays (one entry per facility, in file order) so
+        every facility can be scored against a loan at once. Covenants are static after
+        normalization, so bank and facility restrictions are folded together up-front.
+        '''
+        count = len(self.facilities)
+        self.fac_amount = aligned_array((f.amount for f in self.facilities), np.float64, count)
+        self.fac_interest = aligned_array((f.interest_rate for f in self.facilities), np.float64, count)
+        # no default likelihood covenant means any loan is acceptable
+        self.fac_max_dl = aligned_array(
+            (np.inf if f._eff_max_dl is None else f._eff_max_dl for f in self.facilities),
+            np.float64, count,
+        )
+        self.fac_banned_mask = aligned_array((f._banned_mask for f in self.facilities), np.uint64, count)
+
+    def build_loan_arrays(self) -> None:
+        '''
+        Lays out the loan fields used for scoring as parallel arrays, in streaming order.
+        '''
+        count = len(self.loans)
+        self.loan_amount = aligned_array((l.amount for l in self.loans), np.float64, count)
+        self.loan_dl = aligned_array((l.default_likelihood for l in self.loans), np.float64, count)
+        self.loan_coeff = aligned_array((l._yield_coeff for l in self.loans), np.float64, count)
+        self.loan_state_bit = aligned_array((l._state_bit for l in self.loans), np.uint64, count)
+
+    def make_assignments(self) -> None:
+        # smallest loan amount still to come at each point in the stream
+        min_remaining = np.minimum.accumulate(self.loan_amount[::-1])[::-1]
+        # facilities too small for any loan are never worth scanning
+        smallest = min_remaining[0] if len(min_remaining) else np.inf
+        active = np.flatnonzero(self.fac_amount >= smallest)
+        # sorted by max default likelihood, so each loan only scans the facilities that allow it
+        active = active[np.argsort(self.fac_max_dl[active], kind='stable')]
+        active_dl = self.fac_max_dl[active]
+
+        n_loans = len(self.loans)
+        best = np.empty(n_loans, dtype=np.int64)
+        best_yield = np.empty(n_loans, dtype=np.float64)
+        n_active = len(active)
+        # scoring ahead only pays off when there is more than one thread to score on
+        speculate = get_num_threads() > 1
+        start = 0
+        while start < n_loans:
+            if not speculate:
+                assign_loans(start, n_loans, best, best_yield, min_remaining,
+                             self.loan_amount, self.loan_dl, self.loan_coeff, self.loan_state_bit,
+                             active, active_dl, n_active,
+                             self.fac_amount, self.fac_interest, self.fac_banned_mask)
+                break
+            stop = min(start + SPECULATE_BLOCK, n_loans)
+            score_loans(start, stop, best, best_yield,
+                        self.loan_amount, self.loan_dl, self.loan_coeff, self.loan_state_bit,
+                        active, active_dl, n_active,
+                        self.fac_amount, self.fac_interest, self.fac_banned_mask)
+            n_active, rescored = resolve_assignments(
+                start, stop, best, best_yield, min_remaining,
+                self.loan_amount, self.loan_dl, self.loan_coeff, self.loan_state_bit,
+                active, active_dl, n_active,
+                self.fac_amount, self.fac_interest, self.fac_banned_mask)
+            # once facilities run short most picks go stale, and rescoring them serially
+            # costs more than scoring ahead saves
+            speculate = rescored <= MAX_RESCORE_RATE * (stop - start)
+            start = stop
+
+        # the arrays hold the result, now bring the facility and loan objects up to date
+        for loan, index, expected_yield in zip(self.loans, best, best_yield):
+            if index < 0:
+                log.warning('Unable to assign loan: %s, Amount: %s', loan.id, loan.amount)
+                continue
+            self.facilities[index].assign_loan(loan, float(expected_yield))
+
+    def write_assignments(self) -> None:
+        rows = ['loan_id,facility_id\n']
         for loan in self.loans:
             if not loan.assigned_facility:
-                logging.warning('Loan ID: {} was not assigned.'.format(loan.id))
+                log.warning('Loan ID: %s was not assigned.', loan.id)
                 continue
-            logging.info('Loan ID: {} assigned to: {}'.format(loan.id, loan.assigned_facility.id))
-            f.write('{},{}\n'.format(loan.id, loan.assigned_facility.id))
-        f.flush()
-        f.close()
-
-    def write_yields(self):
-        f = open('yields_ben.csv', 'w')
-        f.write('facility_id,expected_yield\n')
-        for facility in self.facilities:
-            logging.info('Facility ID: {} yielded: {}'.format(facility.id, facility.calculate_total_yield()))
-            f.write('{},{}\n'.format(facility.id, facility.calculate_total_yield()))
-        f.flush()
-        f.close()
+            log.info('Loan ID: %s assigned to: %s', loan.id, loan.assigned_facility.id)
+            rows.append('{},{}\n'.format(loan.id, loan.assigned_facility.id))
+        with open('assignment_ben.csv', 'w') as f:
+            f.write(''.join(rows))
 
-    def log_status(self):
-        logging.info('Facility Status:')
+    def write_yields(self) -> None:
+        rows = ['facility_id,expected_yield\n']
+        for facility in self.facilities:
+            total_yield = facility.calculate_total_yield()
+            log.info('Facility ID: %s yielded: %s', facility.id, total_yield)
+            rows.append('{},{}\n'.format(facility.id, total_yield))
+        with open('yields_ben.csv', 'w') as f:
+            f.write(''.join(rows))
+
+    def log_status(self) -> None:
+        log.info('Facility Status:')
         for facility in self.facilities:
-            logging.info(str(facility))
-        logging.info('Loan Status:')
+            log.info('%s', facility)
+        log.info('Loan Status:')
         for loan in self.loans:
-            logging.info(str(loan))
-        logging.info('Unassigned Loans:')
+            log.info('%s', loan)
+        log.info('Unassigned Loans:')
         for loan in self.loans:
             if not loan.assigned_facility:
-                logging.info(str(loan))
+                log.info('%s', loan)
 
 
-if __name__ == '__main__':
+def main() -> None:
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
     balancier = Balancier()
     balancier.read_data('large')
     balancier.normalize_data()
@@ -256,3 +426,7 @@ if __name__ == '__main__':
     balancier.write_assignments()
     balancier.write_yields()
     balancier.log_status()
+
+
+if __name__ == '__main__':
+    main()
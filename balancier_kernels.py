@@ -0,0 +1,144 @@
+'''
+numba kernels behind Balancier.make_assignments. They work on the parallel facility and loan
+arrays built by Balancier.normalize_data and are kept out of balancier.py so that module can
+be compiled ahead of time with mypyc, which numba cannot JIT.
+'''
+import numpy as np
+
+try:
+    from numba import get_num_threads, njit, prange  # type: ignore[import-not-found, import-untyped, unused-ignore]
+except ImportError:
+    # without numba the kernels below still work, just as plain Python
+    def njit(*args, **kwargs):  # type: ignore[no-redef]
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range  # type: ignore[misc]
+
+    def get_num_threads():  # type: ignore[misc]
+        return 1
+
+
+# fastmath is left off: it measured no faster here, and it lets LLVM assume there are no
+# infinities, which best_facility's -inf yield for "no facility" and the inf max default
+# likelihood of facilities without that covenant both rely on
+@njit(cache=True)
+def best_facility(amount, default_likelihood, yield_coeff, state_bit, active, active_dl, n_active,
+                  fac_amount, fac_interest, fac_banned_mask):
+    '''
+    Finds the valid facility with the highest expected yield for a single loan, looking only
+    at the first n_active facility indices in active. Those are ordered by max default
+    likelihood, given alongside in active_dl, so facilities too strict for the loan are
+    skipped with a binary search. yield_coeff is the loan's Loan._yield_coeff.
+
+    Returns the facility index and its yield, or -1 when no facility can take the loan. Ties
+    go to the facility listed first in the file.
+    '''
+    best = -1
+    best_yield = -np.inf
+    for k in range(np.searchsorted(active_dl[:n_active], default_likelihood), n_active):
+        i = active[k]
+        if fac_banned_mask[i] & state_bit:
+            continue
+        if amount > fac_amount[i]:
+            continue
+        expected_yield = amount * (yield_coeff - fac_interest[i])
+        if expected_yield > best_yield or (expected_yield == best_yield and i < best):
+            best_yield = expected_yield
+            best = i
+    return best, best_yield
+
+
+@njit(cache=True)
+def reserve(l, index, min_remaining, loan_amount, active, active_dl, n_active, fac_amount):
+    '''
+    Takes loan l's amount out of facility index and returns the new n_active.
+
+    min_remaining[l] is the smallest loan amount from loan l onwards. Once a facility drops
+    below the smallest loan still to come it can never be picked again, so it is removed
+    from the first n_active entries of active and active_dl (keeping their order) to
+    shorten later scans.
+    '''
+    fac_amount[index] -= loan_amount[l]
+    if l + 1 < len(loan_amount) and fac_amount[index] < min_remaining[l + 1]:
+        k = 0
+        while active[k] != index:
+            k += 1
+        n_active -= 1
+        for j in range(k, n_active):
+            active[j] = active[j + 1]
+            active_dl[j] = active_dl[j + 1]
+    return n_active
+
+
+@njit(cache=True)
+def assign_loans(start, stop, best, best_yield, min_remaining,
+                 loan_amount, loan_dl, loan_coeff, loan_state_bit,
+                 active, active_dl, n_active,
+                 fac_amount, fac_interest, fac_banned_mask):
+    '''
+    Assigns loans start to stop one at a time, in order, each to its best facility at that
+    point. Picks go into best and best_yield. Returns the new n_active.
+    '''
+    for l in range(start, stop):
+        index, expected_yield = best_facility(
+            loan_amount[l], loan_dl[l], loan_coeff[l], loan_state_bit[l],
+            active, active_dl, n_active,
+            fac_amount, fac_interest, fac_banned_mask,
+        )
+        best[l] = index
+        best_yield[l] = expected_yield
+        if index >= 0:
+            n_active = reserve(l, index, min_remaining, loan_amount, active, active_dl, n_active,
+                               fac_amount)
+    return n_active
+
+
+@njit(cache=True, parallel=True)
+def score_loans(start, stop, best, best_yield,
+                loan_amount, loan_dl, loan_coeff, loan_state_bit,
+                active, active_dl, n_active,
+                fac_amount, fac_interest, fac_banned_mask):
+    '''
+    Speculatively picks the best facility for loans start to stop against the current
+    capacities, into best and best_yield. Loans are scored independently, so this runs
+    across all cores.
+    '''
+    for l in prange(start, stop):
+        index, expected_yield = best_facility(
+            loan_amount[l], loan_dl[l], loan_coeff[l], loan_state_bit[l],
+            active, active_dl, n_active,
+            fac_amount, fac_interest, fac_banned_mask,
+        )
+        best[l] = index
+        best_yield[l] = expected_yield
+
+
+@njit(cache=True)
+def resolve_assignments(start, stop, best, best_yield, min_remaining,
+                        loan_amount, loan_dl, loan_coeff, loan_state_bit,
+                        active, active_dl, n_active,
+                        fac_amount, fac_interest, fac_banned_mask):
+    '''
+    Walks the speculative picks for loans start to stop in order, reserving capacity as it
+    goes. Capacity only ever shrinks, so a pick that still fits is still the best one; only
+    loans whose facility ran out in the meantime are scored again.
+
+    Returns the new n_active and how many loans had to be scored again.
+    '''
+    rescored = 0
+    for l in range(start, stop):
+        index = best[l]
+        if index >= 0 and loan_amount[l] > fac_amount[index]:
+            index, expected_yield = best_facility(
+                loan_amount[l], loan_dl[l], loan_coeff[l], loan_state_bit[l],
+                active, active_dl, n_active,
+                fac_amount, fac_interest, fac_banned_mask,
+            )
+            best[l] = index
+            best_yield[l] = expected_yield
+            rescored += 1
+        if index >= 0:
+            n_active = reserve(l, index, min_remaining, loan_amount, active, active_dl, n_active,
+                               fac_amount)
+    return n_active, rescored
@@ -0,0 +1,155 @@
+import random
+
+import pytest
+
+import balancier
+from balancier import Balancier, Facility, Loan
+
+STATES = ['CA', 'NY', 'TX', 'FL', 'WA']
+
+
+def write_data(directory, seed, n_facilities=40, n_loans=3000):
+    '''
+    Writes a random data set with only a few distinct interest rates, so many facilities tie
+    on yield, and far less capacity than the loans ask for, so facilities run out mid-stream.
+    Columns are shuffled and loans.csv ends in a blank line.
+    '''
+    rng = random.Random(seed)
+    n_banks = 5
+    with open(directory / 'banks.csv', 'w') as f:
+        f.write('name,id\n')
+        f.writelines('Bank {0},{0}\n'.format(i) for i in range(1, n_banks + 1))
+    with open(directory / 'facilities.csv', 'w') as f:
+        f.write('interest_rate,id,bank_id,amount\n')
+        for i in range(1, n_facilities + 1):
+            f.write('{},{},{},{}\n'.format(rng.choice([0.01, 0.02, 0.03]), i,
+                                           rng.randint(1, n_banks), rng.choice([20000, 50000])))
+    with open(directory / 'covenants.csv', 'w') as f:
+        f.write('facility_id,max_default_likelihood,bank_id,banned_state\n')
+        for i in range(1, n_facilities + 1):
+            if rng.random() < 0.5:
+                f.write('{},{},{},{}\n'.format(i, rng.choice([0.05, 0.1, '']), rng.randint(1, n_banks),
+                                               rng.choice(STATES + [''])))
+        for i in range(1, n_banks + 1):
+            if rng.random() < 0.5:
+                f.write(',{},{},{}\n'.format(rng.choice([0.15, '']), i, rng.choice(STATES)))
+    with open(directory / 'loans.csv', 'w') as f:
+        f.write('state,amount,id,default_likelihood,interest_rate\n')
+        for i in range(1, n_loans + 1):
+            f.write('{},{},{},{},{}\n'.format(rng.choice(STATES), rng.randint(1, 20) * 100, i,
+                                              rng.choice([0.01, 0.05, 0.1, 0.2]),
+                                              rng.choice([0.1, 0.2, 0.3])))
+        f.write('\n')
+
+
+def write_csvs(directory, banks=(), facilities=(), covenants=(), loans=()):
+    '''
+    Writes the four input files from rows given in the order of the *_FIELDS tuples.
+    '''
+    tables = [
+        ('banks.csv', balancier.BANK_FIELDS, banks),
+        ('facilities.csv', balancier.FACILITY_FIELDS, facilities),
+        ('covenants.csv', balancier.COVENANT_FIELDS, covenants),
+        ('loans.csv', balancier.LOAN_FIELDS, loans),
+    ]
+    for filename, fields, rows in tables:
+        with open(directory / filename, 'w') as f:
+            f.write(','.join(fields) + '\n')
+            f.writelines(','.join(str(value) for value in row) + '\n' for row in rows)
+
+
+def load(directory):
+    result = Balancier()
+    result.read_data(str(directory))
+    result.normalize_data()
+    return result
+
+
+@pytest.mark.parametrize('threads, max_rescore_rate', [(1, 0.25), (4, 0.25), (4, 1.0)])
+@pytest.mark.parametrize('seed', range(5))
+def test_make_assignments_matches_greedy(tmp_path, monkeypatch, seed, threads, max_rescore_rate):
+    write_data(tmp_path, seed)
+    monkeypatch.setattr(balancier, 'get_num_threads', lambda: threads)
+    monkeypatch.setattr(balancier, 'MAX_RESCORE_RATE', max_rescore_rate)
+    monkeypatch.setattr(balancier, 'SPECULATE_BLOCK', 64)
+
+    actual = load(tmp_path)
+    actual.make_assignments()
+
+    # plain streaming greedy: each loan in turn goes to the first best facility in file order
+    expected = load(tmp_path)
+    for loan in expected.loans:
+        loan.assign(expected.facilities)
+
+    assert len(actual.loans) == 3000
+    assert any(loan.assigned_facility is None for loan in expected.loans)
+    for got, want in zip(actual.loans, expected.loans):
+        assert (got.assigned_facility and got.assigned_facility.id) == \
+            (want.assigned_facility and want.assigned_facility.id), got.id
+        assert got.expected_yield == want.expected_yield, got.id
+    assert [f.amount for f in actual.facilities] == [f.amount for f in expected.facilities]
+    assert [f.calculate_total_yield() for f in actual.facilities] == \
+        [f.calculate_total_yield() for f in expected.facilities]
+
+
+def test_covenants_keep_smallest_max_default_likelihood(tmp_path):
+    write_csvs(
+        tmp_path,
+        banks=[(1, 'Bank')],
+        # facility 1 is cheaper, so it gets every loan its covenants allow
+        facilities=[(1, 1, 10000, 0.01), (2, 1, 10000, 0.02)],
+        covenants=[(1, 1, 0.2, ''), (1, 1, 0.1, ''), (1, '', 0.15, '')],
+        loans=[(1, 100, 0.3, 0.1, 'CA'), (2, 100, 0.3, 0.12, 'CA'), (3, 100, 0.3, 0.2, 'CA')],
+    )
+    result = load(tmp_path)
+    first, second = result.facilities
+    assert first._eff_max_dl == 0.1
+    assert second._eff_max_dl == 0.15
+    assert [first.validate_loan(loan) for loan in result.loans] == [True, False, False]
+    assert [second.validate_loan(loan) for loan in result.loans] == [True, True, False]
+
+    result.make_assignments()
+    assert [loan.assigned_facility for loan in result.loans] == [first, second, None]
+
+
+@pytest.mark.parametrize('facilities, covenants, message', [
+    ([(1, 2, 100, 0.01)], [], 'Facility 1 has unknown bank: 2'),
+    ([(1, -1, 100, 0.01)], [], 'Facility 1 has unknown bank: -1'),
+    ([(1, 1, 100, 0.01)], [(3, '', 0.1, '')], 'Covenant has unknown bank: 3'),
+    ([(1, 1, 100, 0.01)], [(1, 5, 0.1, '')], 'Covenant has unknown facility: 5'),
+])
+def test_unknown_ids_raise_key_error(tmp_path, facilities, covenants, message):
+    write_csvs(tmp_path, banks=[(1, 'Bank')], facilities=facilities, covenants=covenants)
+    with pytest.raises(KeyError, match=message):
+        load(tmp_path)
+
+
+@pytest.mark.parametrize('interest_rates, expected', [
+    # the loan's yield coefficient is 0.1, so these give yields of 0 and 5
+    ([0.1, 0.05], 1),
+    # a later zero yield must not replace a better one
+    ([0.05, 0.1], 0),
+    # ties go to the facility listed first
+    ([0.05, 0.05], 0),
+    # an all-negative set still takes the least negative yield
+    ([0.3, 0.2, 0.4], 1),
+])
+def test_loan_assign_picks_highest_yield(interest_rates, expected):
+    loan = Loan(1, 100., 0.1, 0., 'CA')
+    facilities = [Facility(i, 1, 1000., rate) for i, rate in enumerate(interest_rates)]
+    # a facility too small for the loan, scanned last, must not be the one returned
+    facilities.append(Facility(len(facilities), 1, 10., 0.))
+
+    assert loan.assign(facilities) is facilities[expected]
+    assert loan.assigned_facility is facilities[expected]
+    assert loan.expected_yield == pytest.approx(100. * (0.1 - interest_rates[expected]))
+    assert facilities[expected].amount == 900.
+    assert facilities[expected].assigned_loans == [loan]
+
+
+def test_loan_assign_returns_none_without_valid_facility():
+    loan = Loan(1, 100., 0.1, 0., 'CA')
+    facilities = [Facility(1, 1, 10., 0.01)]
+    assert loan.assign(facilities) is None
+    assert loan.assigned_facility is None
+    assert facilities[0].amount == 10.